@@ -2,13 +2,20 @@
 
 import os
 import json
-from typing import Tuple
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Optional, Tuple
+from cachetools import TTLCache
 from fastapi import HTTPException
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp
 from google_auth_oauthlib.flow import Flow
 from googleapiclient.discovery import build
 from backend.config import settings
+from backend.http_transport import HttpxHttp
 
 
 class GoogleAuth:
@@ -19,9 +26,15 @@ class GoogleAuth:
         self.client_secret = settings.google_client_secret
         self.redirect_uri = settings.redirect_uri
         self.scopes = settings.google_scopes
+        self.session_dir = Path(settings.session_dir)
+        # Built API clients per session: {session_id: (service, credentials)}.
+        # Bounded so sessions that never come back are evicted; TTLCache is not
+        # thread-safe, so access goes through the lock
+        self._drive = TTLCache(maxsize=1024, ttl=3600)
+        self._service_lock = threading.Lock()
         
-    def get_authorization_url(self, state: str = None) -> Tuple[str, Flow]:
-        """Get Google OAuth authorization URL"""
+    def create_flow(self, state: str = None, code_verifier: str = None) -> Flow:
+        """Create an OAuth flow, optionally restoring a stored PKCE code verifier"""
         flow = Flow.from_client_config(
             {
                 "web": {
@@ -33,12 +46,19 @@ class GoogleAuth:
                 }
             },
             scopes=self.scopes,
-            redirect_uri=self.redirect_uri
+            redirect_uri=self.redirect_uri,
+            state=state
         )
+        if code_verifier:
+            flow.code_verifier = code_verifier
+        return flow
+    
+    def get_authorization_url(self, state: str = None) -> Tuple[str, Flow]:
+        """Get Google OAuth authorization URL"""
+        flow = self.create_flow(state=state)
         
         auth_url, _ = flow.authorization_url(
             access_type='offline',
-            include_granted_scopes='true',
             state=state,
             prompt='consent'
         )
@@ -65,19 +85,72 @@ class GoogleAuth:
         """Convert dictionary to credentials object"""
         return Credentials(**creds_dict)
     
+    def _session_path(self, session_id: str) -> Path:
+        """Path of the credentials file for a session"""
+        # Session IDs are UUIDs we issued; reject anything else to keep paths inside session_dir
+        return self.session_dir / f"{uuid.UUID(session_id)}.json"
+    
+    def save_session(self, session_id: str, credentials: Credentials):
+        """Persist session credentials to disk so they survive restarts"""
+        self.session_dir.mkdir(parents=True, exist_ok=True)
+        path = self._session_path(session_id)
+        # Create the file owner-only so the refresh token is never readable by others
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        # The mode above only applies to new files; tighten an existing one too
+        os.fchmod(fd, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(credentials.to_json())
+    
+    def load_session(self, session_id: str) -> Optional[Credentials]:
+        """Load persisted session credentials, or None if there are none"""
+        try:
+            path = self._session_path(session_id)
+            info = json.loads(path.read_text(encoding="utf-8"))
+            return Credentials.from_authorized_user_info(info, self.scopes)
+        except (ValueError, OSError):
+            return None
+    
+    def purge_stale_sessions(self) -> int:
+        """Delete persisted sessions older than session_max_age_days"""
+        if not self.session_dir.exists():
+            return 0
+        
+        cutoff = time.time() - settings.session_max_age_days * 86400
+        removed = 0
+        for path in self.session_dir.glob("*.json"):
+            try:
+                if path.stat().st_mtime < cutoff:
+                    path.unlink()
+                    removed += 1
+            except OSError:
+                continue
+        return removed
+    
     def refresh_credentials_if_needed(self, credentials: Credentials) -> Credentials:
         """Refresh credentials if they are expired"""
         if credentials and credentials.expired and credentials.refresh_token:
             credentials.refresh(Request())
         return credentials
     
-    def get_authenticated_service(self, credentials: Credentials):
-        """Get authenticated Google Drive service"""
+    def _get_service(self, cache: TTLCache, api: str, version: str,
+                     credentials: Credentials, session_id: Optional[str]):
+        """Build an API client, reusing the session's client while its credentials are valid"""
+        if session_id:
+            with self._service_lock:
+                cached = cache.get(session_id)
+            if cached is not None and not cached[1].expired:
+                return cached[0]
+        
         credentials = self.refresh_credentials_if_needed(credentials)
-        return build('drive', 'v3', credentials=credentials)
+        # Requests go through the shared, thread-safe httpx client
+        http = AuthorizedHttp(credentials, http=HttpxHttp())
+        service = build(api, version, http=http,
+                        static_discovery=True, cache_discovery=False)
+        if session_id:
+            with self._service_lock:
+                cache[session_id] = (service, credentials)
+        return service
     
-    def get_docs_service(self, credentials: Credentials):
-        """Get authenticated Google Docs service"""
-        credentials = self.refresh_credentials_if_needed(credentials)
-        return build('docs', 'v1', credentials=credentials)
-
+    def get_authenticated_service(self, credentials: Credentials, session_id: Optional[str] = None):
+        """Get authenticated Google Drive service"""
+        return self._get_service(self._drive, 'drive', 'v3', credentials, session_id)
@@ -20,17 +20,40 @@ class Settings(BaseSettings):
     
     # Session
     secret_key: str = "default-secret-key-change-in-production"
+    session_dir: str = "./sessions"
+    session_max_age_days: int = 30
+    # Share sessions between workers via Redis (e.g. redis://localhost:6379/0); empty keeps them in memory
+    redis_url: str = ""
     
     # Embeddings
     use_local_embeddings: bool = True
+    # sentence-transformers backend: "onnx", "openvino" or "torch"
+    embedding_backend: str = "onnx"
+    # Optional model file for the backend, e.g. onnx/model_qint8_avx512_vnni.onnx
+    embedding_model_file: str = ""
+    # OpenAI embeddings (used when use_local_embeddings is False); changing
+    # either setting requires clearing the knowledge base. Dimensions are only
+    # supported by text-embedding-3 models; 0 leaves them at the model default
+    openai_embedding_model: str = "text-embedding-3-small"
+    openai_embedding_dimensions: int = 256
+    
+    # Client-side pacing of Google Drive calls per session (Drive's default
+    # quota is 12,000 queries/min/user); the burst covers one full batch request
+    google_api_requests_per_minute: int = 12000
+    google_api_burst: int = 100
+    
+    # Extra origins allowed to call the API cross-origin; the bundled frontend is same-origin
+    cors_origins: list = []
+    
+    # Logging
+    log_level: str = "INFO"
     
     # ChromaDB
     chroma_db_path: str = "./chroma_db"
     
     # Scopes for Google APIs
     google_scopes: list = [
-        'https://www.googleapis.com/auth/drive.readonly',
-        'https://www.googleapis.com/auth/documents.readonly'
+        'https://www.googleapis.com/auth/drive.readonly'
     ]
     
     class Config:
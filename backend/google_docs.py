@@ -1,9 +1,41 @@
 """Google Docs API integration"""
 
-from typing import List, Dict
+import asyncio
+import codecs
+import threading
+from typing import List, Dict, Optional
+from cachetools import TTLCache
 from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaIoBaseDownload
 from backend.auth import GoogleAuth
+from backend.config import settings
 from backend.models import DocumentInfo
+from backend.rate_limit import TokenBucket
+
+GOOGLE_DOC_MIME_TYPE = "application/vnd.google-apps.document"
+
+# Cache lifetime (seconds) for Drive listings
+DOCUMENT_LIST_TTL = 60
+
+# Bytes requested per round trip when downloading document exports
+EXPORT_CHUNK_SIZE = 1024 * 1024
+
+
+class _TextSink:
+    """Write target for MediaIoBaseDownload that decodes UTF-8 as chunks arrive"""
+    
+    def __init__(self):
+        # utf-8-sig drops the byte order mark Drive puts in front of text exports
+        self._decoder = codecs.getincrementaldecoder('utf-8-sig')()
+        self._parts: List[str] = []
+    
+    def write(self, data: bytes) -> int:
+        self._parts.append(self._decoder.decode(data))
+        return len(data)
+    
+    def getvalue(self) -> str:
+        self._parts.append(self._decoder.decode(b'', final=True))
+        return ''.join(self._parts)
 
 
 class GoogleDocsService:
@@ -11,107 +43,173 @@ class GoogleDocsService:
     
     def __init__(self):
         self.auth = GoogleAuth()
+        # Per-session caches; TTLCache is not thread-safe, so access goes through the lock
+        self._cache_lock = threading.Lock()
+        self._documents_cache = TTLCache(maxsize=256, ttl=DOCUMENT_LIST_TTL)
+        self._rate_limiters = TTLCache(maxsize=1024, ttl=3600)
+    
+    def rate_limiter(self, session_id: Optional[str]) -> TokenBucket:
+        """Token bucket pacing Google API calls made for a session"""
+        with self._cache_lock:
+            bucket = self._rate_limiters.get(session_id)
+            if bucket is None:
+                bucket = TokenBucket(
+                    capacity=settings.google_api_burst,
+                    rate=settings.google_api_requests_per_minute / 60
+                )
+                self._rate_limiters[session_id] = bucket
+            return bucket
     
-    def get_all_documents(self, credentials) -> List[DocumentInfo]:
+    def invalidate_cache(self, session_id: str):
+        """Drop the cached listing for a session"""
+        with self._cache_lock:
+            self._documents_cache.pop(session_id, None)
+    
+    async def get_all_documents(self, credentials, session_id: Optional[str] = None) -> List[DocumentInfo]:
         """Fetch all Google Docs for the authenticated user"""
+        if session_id:
+            with self._cache_lock:
+                cached = self._documents_cache.get(session_id)
+            if cached is not None:
+                return cached
+        
         try:
-            drive_service = self.auth.get_authenticated_service(credentials)
+            drive_service = self.auth.get_authenticated_service(credentials, session_id)
             
             # Fetch Google Docs visible to the user, including:
             # - User's own files
             # - Files shared with the user (sharedWithMe)
             # - Files in shared drives (if any)
             queries = [
-                "mimeType='application/vnd.google-apps.document' and trashed=false",
-                "mimeType='application/vnd.google-apps.document' and trashed=false and sharedWithMe"
+                f"mimeType='{GOOGLE_DOC_MIME_TYPE}' and trashed=false",
+                f"mimeType='{GOOGLE_DOC_MIME_TYPE}' and trashed=false and sharedWithMe"
             ]
-            fields = "nextPageToken, files(id, name, mimeType, modifiedTime, webViewLink)"
-            seen_ids = {}
+            # mimeType is implied by the query, so it is not requested
+            fields = "nextPageToken, files(id, name, modifiedTime, webViewLink)"
+            
+            rate_limiter = self.rate_limiter(session_id)
             
-            for q in queries:
+            async def run_query(q: str) -> List[Dict]:
+                files = []
                 page_token = None
                 while True:
-                    resp = drive_service.files().list(
+                    request = drive_service.files().list(
                         q=q,
                         fields=fields,
                         orderBy="modifiedTime desc",
                         includeItemsFromAllDrives=True,
                         supportsAllDrives=True,
                         corpora="allDrives",
+                        pageSize=1000,
                         pageToken=page_token
-                    ).execute()
-                    for f in resp.get('files', []):
-                        seen_ids[f['id']] = f
+                    )
+                    async with rate_limiter:
+                        resp = await asyncio.to_thread(request.execute)
+                    files.extend(resp.get('files', []))
                     page_token = resp.get('nextPageToken')
                     if not page_token:
                         break
+                return files
+            
+            # The queries are independent, so run them concurrently
+            results = await asyncio.gather(*(run_query(q) for q in queries))
+            
+            seen_ids = {}
+            for files in results:
+                for f in files:
+                    seen_ids[f['id']] = f
             
             documents: List[DocumentInfo] = []
             for file in seen_ids.values():
                 documents.append(DocumentInfo(
                     id=file['id'],
                     name=file['name'],
-                    mimeType=file['mimeType'],
+                    mimeType=GOOGLE_DOC_MIME_TYPE,
                     modifiedTime=file.get('modifiedTime', ''),
                     webViewLink=file.get('webViewLink')
                 ))
             
             # Sort by modified time desc (already ordered, but ensure after merge)
             documents.sort(key=lambda d: d.modifiedTime or "", reverse=True)
+            
+            if session_id:
+                with self._cache_lock:
+                    self._documents_cache[session_id] = documents
             return documents
             
         except HttpError as error:
             raise Exception(f"Error fetching documents: {error}")
     
-    def get_document_content(self, document_id: str, credentials) -> str:
+    def get_document_content(self, document_id: str, credentials, session_id: Optional[str] = None) -> str:
         """Extract text content from a Google Doc"""
         try:
-            docs_service = self.auth.get_docs_service(credentials)
-            
-            document = docs_service.documents().get(documentId=document_id).execute()
-            
-            # Extract text from all elements
-            text_content = []
-            
-            def extract_text(elements):
-                """Recursively extract text from document elements"""
-                for element in elements:
-                    if 'paragraph' in element:
-                        para = element['paragraph']
-                        if 'elements' in para:
-                            for elem in para['elements']:
-                                if 'textRun' in elem:
-                                    text_content.append(elem['textRun'].get('content', ''))
-                    if 'table' in element:
-                        table = element['table']
-                        if 'tableRows' in table:
-                            for row in table['tableRows']:
-                                if 'tableCells' in row:
-                                    for cell in row['tableCells']:
-                                        if 'content' in cell:
-                                            extract_text(cell['content'])
-            
-            if 'body' in document and 'content' in document['body']:
-                extract_text(document['body']['content'])
-            
-            full_text = ''.join(text_content).strip()
+            drive_service = self.auth.get_authenticated_service(credentials, session_id)
+            
+            # Drive's plain-text export returns the document text directly,
+            # with no Docs JSON to download, parse and walk
+            request = drive_service.files().export_media(
+                fileId=document_id,
+                mimeType="text/plain"
+            )
+            
+            # Stream the export and decode it chunk by chunk, so the raw bytes
+            # are never held in memory alongside the decoded text
+            sink = _TextSink()
+            downloader = MediaIoBaseDownload(sink, request, chunksize=EXPORT_CHUNK_SIZE)
+            done = False
+            while not done:
+                _, done = downloader.next_chunk()
+            
+            full_text = sink.getvalue().strip()
             return full_text
             
         except HttpError as error:
             raise Exception(f"Error fetching document content: {error}")
     
-    def get_document_metadata(self, document_id: str, credentials) -> Dict:
-        """Get metadata for a specific document"""
+    def get_cached_metadata(self, document_ids: List[str], session_id: Optional[str]) -> Dict[str, Dict]:
+        """Get whatever metadata for the documents the cached listing has, without calling Drive"""
+        metadata: Dict[str, Dict] = {}
+        if not session_id:
+            return metadata
+        
+        with self._cache_lock:
+            listed = {doc.id: doc for doc in self._documents_cache.get(session_id, ())}
+        for document_id in document_ids:
+            if document_id in listed:
+                metadata[document_id] = listed[document_id].model_dump(exclude={'mimeType'})
+        return metadata
+    
+    async def get_documents_metadata(self, document_ids: List[str], credentials,
+                                     session_id: Optional[str] = None) -> Dict[str, Dict]:
+        """Get current metadata for several documents in batched HTTP requests"""
+        if not document_ids:
+            return {}
+        
         try:
-            drive_service = self.auth.get_authenticated_service(credentials)
+            drive_service = self.auth.get_authenticated_service(credentials, session_id)
+            fetched: Dict[str, Dict] = {}
             
-            file = drive_service.files().get(
-                fileId=document_id,
-                fields="id, name, mimeType, modifiedTime, webViewLink"
-            ).execute()
+            def handle_response(request_id, response, exception):
+                # Documents that fail individually are left out; callers fall back to a default name
+                if exception is None:
+                    fetched[response['id']] = response
             
-            return file
+            rate_limiter = self.rate_limiter(session_id)
+            
+            # Drive accepts at most 100 calls per batch request, and counts each call
+            # against the quota, so every batch pays for its own calls
+            for start in range(0, len(document_ids), 100):
+                batch_ids = document_ids[start:start + 100]
+                batch = drive_service.new_batch_http_request(callback=handle_response)
+                for document_id in batch_ids:
+                    batch.add(drive_service.files().get(
+                        fileId=document_id,
+                        fields="id, name, modifiedTime, webViewLink"
+                    ))
+                await rate_limiter.acquire(len(batch_ids))
+                await asyncio.to_thread(batch.execute)
+            
+            return fetched
             
         except HttpError as error:
             raise Exception(f"Error fetching document metadata: {error}")
-
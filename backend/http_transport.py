@@ -0,0 +1,46 @@
+"""Shared HTTP transport for Google API clients"""
+
+import httplib2
+import httpx
+
+# One pooled HTTP/2 client for every Google API call: requests are multiplexed
+# over a few TLS connections instead of opening one per request.
+# httpx.Client is thread-safe, so worker threads can share it.
+_client = httpx.Client(
+    http2=True,
+    limits=httpx.Limits(max_connections=16),
+    follow_redirects=True,
+    timeout=60.0
+)
+
+
+class HttpxHttp:
+    """httplib2.Http stand-in that sends requests through the shared httpx client.
+
+    googleapiclient and google-auth-httplib2 only call request() and read the
+    (response, content) pair it returns, so that is all this implements.
+    """
+    
+    timeout = None
+    
+    def __init__(self, client: httpx.Client = _client):
+        self.client = client
+        self.connections = {}
+    
+    def request(self, uri, method="GET", body=None, headers=None,
+                redirections=5, connection_type=None, **kwargs):
+        response = self.client.request(method, uri, content=body, headers=headers)
+        content = response.content
+        
+        # httpx has already decoded the body, so the encoding and length headers
+        # must describe the decoded content (MediaIoBaseDownload relies on them)
+        info = {
+            key: value for key, value in response.headers.items()
+            if key not in ('content-encoding', 'content-length', 'transfer-encoding')
+        }
+        info['status'] = str(response.status_code)
+        info['content-length'] = str(len(content))
+        
+        resp = httplib2.Response(info)
+        resp.reason = response.reason_phrase
+        return resp, content
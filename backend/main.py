@@ -1,16 +1,23 @@
 """Main FastAPI application"""
 
+import asyncio
 import json
+import logging
 import uuid
+from typing import Dict, List
+from logging.handlers import QueueHandler, QueueListener
+from queue import Queue
 from pathlib import Path
+import orjson
 from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import RedirectResponse, JSONResponse, FileResponse
+from fastapi.responses import RedirectResponse, JSONResponse, FileResponse, ORJSONResponse, StreamingResponse
 from google.oauth2.credentials import Credentials
 from backend.auth import GoogleAuth
 from backend.google_docs import GoogleDocsService
-from backend.rag_pipeline import RAGPipeline
+from backend.rag_pipeline import RAGPipeline, SearchResult
+from backend.session_store import SessionStore
 from backend.models import (
     DocumentListResponse,
     AddDocumentsRequest,
@@ -22,35 +29,80 @@ from backend.models import (
 )
 from backend.config import settings
 
-app = FastAPI(title="RAG Chatbot with Google Docs", version="1.0.0")
+logger = logging.getLogger(__name__)
+
+app = FastAPI(
+    title="RAG Chatbot with Google Docs",
+    version="1.0.0",
+    default_response_class=ORJSONResponse
+)
 
 # Serve static files
 # Get project root (parent of backend directory)
 frontend_path = Path(__file__).parent.parent / "frontend"
 
-# CORS middleware
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],  # In production, specify exact origins
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+# CORS middleware, only needed when the frontend is served from another origin
+if settings.cors_origins:
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=settings.cors_origins,
+        allow_credentials=True,
+        allow_methods=["GET", "POST", "DELETE"],
+        allow_headers=["content-type"],
+    )
 
 # Initialize services
 auth_service = GoogleAuth()
 docs_service = GoogleDocsService()
 rag_pipeline = RAGPipeline()
 
-# In-memory session storage (use Redis in production)
-user_sessions = {}
-flow_storage = {}
+# Session storage (Redis when REDIS_URL is set, otherwise in memory + disk)
+session_store = SessionStore(auth_service)
 
 # Mount static files if frontend directory exists
 if frontend_path.exists():
     app.mount("/frontend", StaticFiles(directory=str(frontend_path)), name="frontend")
 
 
+# Log records are handed to a queue and written by a listener thread,
+# so request handlers never block on stdout
+log_listener = None
+
+
+def configure_logging():
+    """Route all logging through a QueueHandler drained by a background listener"""
+    global log_listener
+    if log_listener is not None:
+        return
+    
+    log_queue = Queue(-1)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    
+    root_logger = logging.getLogger()
+    root_logger.setLevel(settings.log_level.upper())
+    root_logger.addHandler(QueueHandler(log_queue))
+    
+    log_listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    log_listener.start()
+
+
+@app.on_event("startup")
+async def startup():
+    """Configure logging and drop persisted sessions that are too old to be reused"""
+    configure_logging()
+    removed = session_store.purge_stale_sessions()
+    if removed:
+        logger.info("Removed %d stale session(s)", removed)
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    """Flush queued log records"""
+    if log_listener is not None:
+        log_listener.stop()
+
+
 @app.get("/")
 async def root():
     """Root endpoint - redirect to frontend"""
@@ -70,8 +122,8 @@ async def login(request: Request):
         # Get authorization URL
         auth_url, flow = auth_service.get_authorization_url(state=state)
         
-        # Store flow in session (in production, use secure session storage)
-        flow_storage[state] = flow
+        # Store flow until the callback arrives
+        await session_store.save_flow(state, flow)
         
         return RedirectResponse(url=auth_url)
     
@@ -92,21 +144,17 @@ async def callback(request: Request, code: str = None, state: str = None, error:
         raise HTTPException(status_code=400, detail="Authorization code not provided")
     
     try:
-        # Retrieve flow from storage
-        if state not in flow_storage:
+        # Retrieve flow from storage (each state can only be used once)
+        flow = await session_store.pop_flow(state)
+        if flow is None:
             raise HTTPException(status_code=400, detail="Invalid state parameter")
         
-        flow = flow_storage[state]
-        
         # Exchange code for credentials
         credentials = auth_service.get_credentials_from_code(code, flow)
         
         # Create session
         session_id = str(uuid.uuid4())
-        user_sessions[session_id] = auth_service.credentials_to_dict(credentials)
-        
-        # Clean up flow storage
-        del flow_storage[state]
+        await session_store.save_session(session_id, credentials)
         
         # Redirect to frontend with session ID
         redirect_url = f"/frontend/index.html?session_id={session_id}"
@@ -116,21 +164,20 @@ async def callback(request: Request, code: str = None, state: str = None, error:
         raise HTTPException(status_code=500, detail=f"Error processing callback: {str(e)}")
 
 
-def get_credentials_from_session(session_id: str) -> Credentials:
+async def get_credentials_from_session(session_id: str) -> Credentials:
     """Get credentials from session"""
-    if session_id not in user_sessions:
+    credentials = await session_store.load_session(session_id)
+    if credentials is None:
         raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    creds_dict = user_sessions[session_id]
-    return auth_service.dict_to_credentials(creds_dict)
+    return credentials
 
 
 @app.get("/api/documents")
 async def get_documents(session_id: str):
     """Fetch user's Google Docs"""
     try:
-        credentials = get_credentials_from_session(session_id)
-        documents = docs_service.get_all_documents(credentials)
+        credentials = await get_credentials_from_session(session_id)
+        documents = await docs_service.get_all_documents(credentials, session_id)
         
         return DocumentListResponse(
             documents=documents,
@@ -148,6 +195,21 @@ async def get_documents(session_id: str):
         )
 
 
+# Upper bound on documents ingested concurrently (keeps us under Google API rate limits)
+MAX_CONCURRENT_INGESTS = 8
+
+
+def _fetch_doc(doc_id: str, credentials: Credentials, session_id: str) -> str:
+    """Fetch the text of a single document.
+
+    Runs in a worker thread, so it only uses blocking calls.
+    """
+    logger.debug("Fetching document %s...", doc_id)
+    content = docs_service.get_document_content(doc_id, credentials, session_id)
+    logger.debug("Fetched %d characters for %s", len(content), doc_id)
+    return content
+
+
 @app.post("/api/knowledge-base/add")
 async def add_documents(request: AddDocumentsRequest, session_id: str, clear_first: bool = False):
     """Add documents to knowledge base"""
@@ -156,55 +218,119 @@ async def add_documents(request: AddDocumentsRequest, session_id: str, clear_fir
         if clear_first:
             rag_pipeline.clear_all_documents()
         
-        print(f"Adding {len(request.document_ids)} document(s) to knowledge base...")
-        credentials = get_credentials_from_session(session_id)
+        logger.info("Adding %d document(s) to knowledge base...", len(request.document_ids))
+        credentials = await get_credentials_from_session(session_id)
         
-        added_count = 0
-        errors = []
+        # Modification times of the indexed versions (nothing is indexed right after a clear)
+        def indexed_times() -> Dict[str, str]:
+            times = {}
+            for doc_id in request.document_ids:
+                indexed = rag_pipeline.get_modified_time(doc_id)
+                if indexed:
+                    times[doc_id] = indexed
+            return times
         
+        indexed_modified_times = {} if clear_first else await asyncio.to_thread(indexed_times)
+        
+        # Names come from the client or the cached listing. Drive is asked, in one batched
+        # request, only about indexed documents (whose freshness check needs a current
+        # modifiedTime; a cached listing may predate an edit) and documents with no known name
+        document_names = request.document_names or {}
+        cached_metadata = docs_service.get_cached_metadata(request.document_ids, session_id)
+        fetch_ids = [
+            doc_id for doc_id in dict.fromkeys(request.document_ids)
+            if doc_id in indexed_modified_times or not (document_names.get(doc_id) or doc_id in cached_metadata)
+        ]
+        metadata = {}
+        if fetch_ids:
+            logger.debug("Fetching metadata for %d document(s)...", len(fetch_ids))
+            metadata = await docs_service.get_documents_metadata(fetch_ids, credentials, session_id)
+        
+        doc_names = {}
+        modified_times = {}
         for doc_id in request.document_ids:
-            try:
-                print(f"Processing document {doc_id}...")
-                
-                # Get document content
-                print(f"Fetching content for {doc_id}...")
-                content = docs_service.get_document_content(doc_id, credentials)
-                print(f"Content length: {len(content)} characters")
-                
-                if not content or len(content.strip()) == 0:
-                    print(f"Warning: Document {doc_id} has no content")
-                    errors.append(f"Document {doc_id} is empty")
-                    continue
-                
-                # Get document metadata for name
-                print(f"Fetching metadata for {doc_id}...")
-                metadata = docs_service.get_document_metadata(doc_id, credentials)
-                doc_name = metadata.get('name', f'Document {doc_id}')
-                print(f"Document name: {doc_name}")
-                
-                # Remove existing document if present
-                print(f"Removing old version of {doc_id} if exists...")
-                rag_pipeline.remove_document(doc_id)
-                
-                # Add to knowledge base
-                print(f"Adding {doc_name} to vector database...")
-                rag_pipeline.add_document(doc_id, doc_name, content)
-                added_count += 1
-                print(f"Successfully added {doc_name}!")
-                
-            except Exception as e:
-                # Log error but continue with other documents
-                error_msg = f"Error processing document {doc_id}: {str(e)}"
-                print(error_msg)
-                import traceback
-                traceback.print_exc()
+            doc_metadata = metadata.get(doc_id) or cached_metadata.get(doc_id, {})
+            doc_names[doc_id] = document_names.get(doc_id) or doc_metadata.get('name', f'Document {doc_id}')
+            # Stored with the new version; a listed time can only predate the content
+            # fetched now, which at worst causes one extra re-index later
+            modified_times[doc_id] = doc_metadata.get('modifiedTime', '')
+        
+        # Skip documents whose indexed version is still current; an indexed document
+        # Drive did not answer for is never considered up to date
+        unchanged_ids = {
+            doc_id for doc_id, indexed in indexed_modified_times.items()
+            if metadata.get(doc_id, {}).get('modifiedTime') == indexed
+        }
+        changed_ids = [doc_id for doc_id in request.document_ids if doc_id not in unchanged_ids]
+        if unchanged_ids:
+            logger.info("Skipping %d unchanged document(s)", len(unchanged_ids))
+        
+        rate_limiter = docs_service.rate_limiter(session_id)
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_INGESTS)
+        
+        async def fetch_with_limit(doc_id: str) -> str:
+            async with semaphore, rate_limiter:
+                return await asyncio.to_thread(_fetch_doc, doc_id, credentials, session_id)
+        
+        # Fetch all changed documents concurrently
+        tasks = [asyncio.create_task(fetch_with_limit(doc_id)) for doc_id in changed_ids]
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        docs_service.invalidate_cache(session_id)
+        
+        # Unchanged documents are already in the knowledge base
+        added_count = len(unchanged_ids)
+        errors = []
+        contents = {}
+        
+        for doc_id, result in zip(changed_ids, results):
+            if isinstance(result, Exception):
+                # Log error but keep the results of the other documents
+                error_msg = f"Error processing document {doc_id}: {str(result)}"
+                logger.error(error_msg, exc_info=result)
                 errors.append(error_msg)
-                continue
+            elif not result or len(result.strip()) == 0:
+                logger.warning("Document %s has no content", doc_id)
+                errors.append(f"Document {doc_id} is empty")
+            else:
+                contents[doc_id] = result
+        
+        # Remove old versions in a single delete, only for documents whose new
+        # content was fetched; a failed fetch leaves the indexed version in place
+        if not clear_first and contents:
+            logger.debug("Removing old versions of %d document(s)...", len(contents))
+            await asyncio.to_thread(rag_pipeline.remove_documents, list(contents))
+        
+        async def index_with_limit(doc_id: str):
+            async with semaphore:
+                await asyncio.to_thread(
+                    rag_pipeline.add_document, doc_id, doc_names[doc_id], contents[doc_id], modified_times[doc_id]
+                )
+        
+        # Embed and store the fetched documents concurrently
+        tasks = [asyncio.create_task(index_with_limit(doc_id)) for doc_id in contents]
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        
+        for doc_id, result in zip(contents, results):
+            if isinstance(result, Exception):
+                error_msg = f"Error processing document {doc_id}: {str(result)}"
+                logger.error(error_msg, exc_info=result)
+                errors.append(error_msg)
+            else:
+                logger.debug("Added %s to vector database", doc_names[doc_id])
+                added_count += 1
+        
+        # Store small documents that were held back to be encoded in one batch
+        try:
+            await asyncio.to_thread(rag_pipeline.flush_pending)
+        except Exception as e:
+            errors.append(f"Error storing small documents: {str(e)}")
         
         if added_count > 0:
             return AddDocumentsResponse(
                 success=True,
-                message=f"Successfully added {added_count} document(s) to knowledge base" + (f". Errors: {len(errors)}" if errors else ""),
+                message=f"Successfully added {added_count} document(s) to knowledge base"
+                        + (f" ({len(unchanged_ids)} already up to date)" if unchanged_ids else "")
+                        + (f". Errors: {len(errors)}" if errors else ""),
                 added_count=added_count
             )
         else:
@@ -217,8 +343,7 @@ async def add_documents(request: AddDocumentsRequest, session_id: str, clear_fir
     except HTTPException:
         raise
     except Exception as e:
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error adding documents")
         return AddDocumentsResponse(
             success=False,
             message=f"Error adding documents: {str(e)}",
@@ -254,30 +379,66 @@ async def clear_knowledge_base():
         return {"success": False, "message": f"Error clearing knowledge base: {str(e)}"}
 
 
+def _format_sources(relevant_contexts: SearchResult) -> List[Dict]:
+    """Deduplicate sources by document name, keeping the highest relevance"""
+    sources_dict = {}
+    for metadata, distance in zip(relevant_contexts.metadatas, relevant_contexts.distances):
+        metadata = metadata or {}
+        doc_name = metadata.get('document_name', 'Unknown')
+        score = 1.0 - float(distance)
+        current = sources_dict.get(doc_name)
+        if current is None or score > current['relevance_score']:
+            sources_dict[doc_name] = {
+                'document_name': doc_name,
+                'document_id': metadata.get('document_id', ''),
+                'relevance_score': score
+            }
+    
+    return list(sources_dict.values())
+
+
 @app.post("/api/chat")
 async def chat(request: ChatRequest, session_id: str):
     """Query the chatbot"""
     try:
         # Search in knowledge base
-        retrieved_docs, scores = rag_pipeline.search(request.query, top_k=5)
+        retrieved = rag_pipeline.search(request.query, top_k=5, document_ids=request.document_ids)
         
         # Determine if answer was found in documents
-        # Use a threshold for cosine similarity/distance
-        found_in_documents = False
-        relevant_contexts = []
-        
-        if retrieved_docs:
-            # Use a more lenient threshold - accept results with distance < 1.0
-            # (ChromaDB uses cosine distance, lower is better)
-            for doc, score in zip(retrieved_docs, scores):
-                if score < 1.0:  # More lenient threshold
-                    found_in_documents = True
-                    relevant_contexts.append(doc)
+        # Use a more lenient threshold - accept results with distance < 1.0
+        # (distance is 1 - cosine similarity, lower is better)
+        relevant_contexts = retrieved.within(1.0)
+        found_in_documents = len(relevant_contexts) > 0
         
         # If we have any results, consider it found (even if threshold is high)
-        if retrieved_docs and not found_in_documents:
+        if retrieved and not found_in_documents:
             found_in_documents = True
-            relevant_contexts = retrieved_docs[:3]  # Use top 3 results
+            relevant_contexts = retrieved.head(3)  # Use top 3 results
+        
+        sources = _format_sources(relevant_contexts)
+        
+        # Generate or use conversation ID
+        conversation_id = request.conversation_id or str(uuid.uuid4())
+        
+        if request.stream:
+            pieces = rag_pipeline.generate_response(
+                request.query,
+                relevant_contexts,
+                found_in_documents,
+                stream=True
+            )
+            
+            def stream_events():
+                # First line carries the metadata, then one line per generated text piece
+                yield orjson.dumps({
+                    "sources": sources,
+                    "found_in_documents": found_in_documents,
+                    "conversation_id": conversation_id
+                }) + b"\n"
+                for piece in pieces:
+                    yield orjson.dumps({"delta": piece}) + b"\n"
+            
+            return StreamingResponse(stream_events(), media_type="application/x-ndjson")
         
         # Generate response
         response_text = rag_pipeline.generate_response(
@@ -286,32 +447,6 @@ async def chat(request: ChatRequest, session_id: str):
             found_in_documents
         )
         
-        # Format sources (deduplicate by document name)
-        sources_dict = {}
-        for ctx in relevant_contexts:
-            metadata = ctx.get('metadata', {})
-            doc_name = metadata.get('document_name', 'Unknown')
-            doc_id = metadata.get('document_id', '')
-            
-            # Only add once per document, keep the highest relevance
-            if doc_name not in sources_dict:
-                sources_dict[doc_name] = {
-                    'document_name': doc_name,
-                    'document_id': doc_id,
-                    'relevance_score': 1 - ctx.get('distance', 1.0)
-                }
-            else:
-                # Update if this one has higher relevance
-                current_score = sources_dict[doc_name]['relevance_score']
-                new_score = 1 - ctx.get('distance', 1.0)
-                if new_score > current_score:
-                    sources_dict[doc_name]['relevance_score'] = new_score
-        
-        sources = list(sources_dict.values())
-        
-        # Generate or use conversation ID
-        conversation_id = request.conversation_id or str(uuid.uuid4())
-        
         return ChatResponse(
             response=response_text,
             sources=sources,
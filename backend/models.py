@@ -1,7 +1,7 @@
 """Pydantic models for request/response validation"""
 
 from pydantic import BaseModel
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict
 
 
 class DocumentInfo(BaseModel):
@@ -23,6 +23,8 @@ class DocumentListResponse(BaseModel):
 class AddDocumentsRequest(BaseModel):
     """Request model for adding documents to knowledge base"""
     document_ids: List[str]
+    # Optional {document_id: name} map from the document listing, saves a metadata lookup per doc
+    document_names: Optional[Dict[str, str]] = None
 
 
 class AddDocumentsResponse(BaseModel):
@@ -36,12 +38,23 @@ class ChatRequest(BaseModel):
     """Request model for chatbot queries"""
     query: str
     conversation_id: Optional[str] = None
+    # Restrict retrieval to these documents (all documents when omitted)
+    document_ids: Optional[List[str]] = None
+    # Stream the answer as newline-delimited JSON instead of a single ChatResponse
+    stream: bool = False
+
+
+class Source(BaseModel):
+    """Document cited in a chatbot response"""
+    document_name: str
+    document_id: str
+    relevance_score: float
 
 
 class ChatResponse(BaseModel):
     """Response model for chatbot responses"""
     response: str
-    sources: List[Dict[str, Any]]
+    sources: List[Source]
     found_in_documents: bool
     conversation_id: str
 
@@ -1,14 +1,156 @@
 """RAG (Retrieval-Augmented Generation) Pipeline"""
 
+import functools
+import logging
 import os
+import queue
+import re
+import threading
+import time
 import uuid
-from typing import List, Dict, Tuple, Optional
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Iterator, List, Dict, Tuple, Optional, Union
 import chromadb
+import numpy as np
+import torch
 from chromadb.config import Settings as ChromaSettings
 from sentence_transformers import SentenceTransformer
 from openai import OpenAI
+from transformers import AutoTokenizer
 from backend.config import settings
 
+logger = logging.getLogger(__name__)
+
+# Texts sent per OpenAI embeddings request (keeps requests well under the token limit)
+OPENAI_EMBEDDING_BATCH_SIZE = 256
+
+# Seconds cached collection state (chunk count, document registry) is trusted
+# before asking Chroma again; other workers may write to the same database
+COLLECTION_CACHE_TTL = 5
+
+# Documents shorter than this are held back and encoded together with the next batch
+SMALL_DOCUMENT_CHARS = 200
+
+# A period followed by a space or newline ends a sentence when chunking
+_SENTENCE_END_RE = re.compile(r'\.[ \n]')
+
+# Runs of whitespace collapse to a single space in fallback answers
+_WS_RE = re.compile(r'\s+')
+
+
+def _trim_to_sentence(content: str, limit: int = 500, min_break: int = 300) -> str:
+    """Collapse whitespace and cap content at limit chars, preferring a sentence break"""
+    content = _WS_RE.sub(' ', content).strip()
+    if len(content) <= limit:
+        return content
+    
+    last_period = content.rfind('.', 0, limit)
+    if last_period > min_break:
+        return content[:last_period + 1] + "..."
+    return content[:limit] + "..."
+
+
+@dataclass
+class SearchResult:
+    """Search hits as parallel columns, in the layout Chroma returns them"""
+    contents: List[str] = field(default_factory=list)
+    metadatas: List[Dict] = field(default_factory=list)
+    distances: np.ndarray = field(default_factory=lambda: np.empty(0))
+    
+    def __len__(self) -> int:
+        return len(self.contents)
+    
+    @property
+    def doc_names(self) -> List[str]:
+        return [(metadata or {}).get('document_name', 'Document') for metadata in self.metadatas]
+    
+    def head(self, n: int) -> "SearchResult":
+        """The first n hits"""
+        return SearchResult(self.contents[:n], self.metadatas[:n], self.distances[:n])
+    
+    def within(self, max_distance: float) -> "SearchResult":
+        """Hits closer than max_distance"""
+        keep = np.flatnonzero(self.distances < max_distance)
+        return SearchResult(
+            [self.contents[i] for i in keep],
+            [self.metadatas[i] for i in keep],
+            self.distances[keep]
+        )
+
+
+class _EmbedBatcher:
+    """Coalesce concurrent encode requests into shared model batches.
+
+    Callers submit lists of texts and wait on a Future. A worker thread collects
+    submissions for up to max_wait_ms (or until max_batch texts are queued),
+    encodes them in a single call and hands each caller back its own rows.
+    """
+    
+    def __init__(self, model: SentenceTransformer, max_batch: int = 64, max_wait_ms: float = 10):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name="embed-batcher", daemon=True)
+        self._worker.start()
+    
+    def submit(self, texts: List[str]) -> Future:
+        """Queue texts for encoding; the Future resolves to their normalized embeddings"""
+        future = Future()
+        self._queue.put((texts, future))
+        return future
+    
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """Encode texts, sharing a model batch with any concurrent callers"""
+        return self.submit(texts).result()
+    
+    def _drain(self) -> List[Tuple[List[str], Future]]:
+        """Block for one submission, then gather more until the batch is full or the wait expires"""
+        items = [self._queue.get()]
+        count = len(items[0][0])
+        deadline = time.monotonic() + self.max_wait
+        while count < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            items.append(item)
+            count += len(item[0])
+        return items
+    
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        return self.model.encode(texts, batch_size=min(self.max_batch, len(texts)),
+                                 show_progress_bar=False, convert_to_numpy=True,
+                                 normalize_embeddings=True)
+    
+    def _run(self):
+        while True:
+            items = self._drain()
+            texts = [text for batch, _ in items for text in batch]
+            try:
+                # encode() sorts by length internally, so the merged batch pads efficiently
+                embeddings = self._encode(texts)
+            except Exception as e:
+                if len(items) == 1:
+                    items[0][1].set_exception(e)
+                    continue
+                # Retry each submission alone so only the one that fails gets the error
+                for batch, future in items:
+                    try:
+                        future.set_result(self._encode(batch))
+                    except Exception as e:
+                        future.set_exception(e)
+                continue
+            
+            start = 0
+            for batch, future in items:
+                future.set_result(embeddings[start:start + len(batch)])
+                start += len(batch)
+
 
 class RAGPipeline:
     """RAG pipeline for document retrieval and answer generation"""
@@ -18,6 +160,7 @@ class RAGPipeline:
         self.collection = None
         self.embedding_model = None
         self.openai_client = None
+        self._embed_batcher = None
         self._initialize()
     
     def _initialize(self):
@@ -32,14 +175,23 @@ class RAGPipeline:
         )
         
         # Get or create collection
-        self.collection = self.chroma_client.get_or_create_collection(
-            name="documents",
-            metadata={"hnsw:space": "cosine"}
-        )
+        self.collection = self._get_or_create_collection()
+        self._count_cache = None
+        self._count_generation = 0
+        # Small documents waiting to be encoded, keyed by document_id so a
+        # document queued twice is stored once:
+        # document_id -> (document_id, document_name, modified_time, chunks)
+        self._pending_small_docs = {}
+        self._pending_lock = threading.Lock()
+        # document_id -> document_name for every stored document. Local writes update it
+        # directly; it is rebuilt from the collection once it is older than COLLECTION_CACHE_TTL
+        self._doc_registry = self._load_doc_registry()
+        self._doc_registry_loaded = time.monotonic()
         
         # Initialize embedding model
         if settings.use_local_embeddings:
-            self.embedding_model = SentenceTransformer('all-MiniLM-L6-v2')
+            self.embedding_model = self._load_embedding_model()
+            self._embed_batcher = _EmbedBatcher(self.embedding_model)
         else:
             # Will use OpenAI embeddings
             pass
@@ -49,194 +201,456 @@ class RAGPipeline:
             self.openai_client = OpenAI(api_key=settings.openai_api_key)
         else:
             self.openai_client = None
+        
+        # Repeated queries reuse their embedding; rebuilt whenever the model is (re)loaded
+        self._cached_query_embedding = functools.lru_cache(maxsize=2048)(self._embed_query)
+        # Fallback answers are a pure function of the query and retrieved chunks
+        self._simple_response_cache = functools.lru_cache(maxsize=256)(self._format_simple_response)
+        
+        # Pay the first-call cost (session setup, kernel selection, tokenizer
+        # loading) at startup rather than on the first user request
+        if self.embedding_model:
+            self.embedding_model.encode(["warmup"] * 4, batch_size=4, convert_to_numpy=True,
+                                        normalize_embeddings=True)
+    
+    def _count(self) -> int:
+        """Number of chunks in the collection, cached briefly or until the next local mutation"""
+        cached = self._count_cache
+        # Other workers write to the same database, so even unchanged local state expires
+        if cached is not None and time.monotonic() - cached[1] < COLLECTION_CACHE_TTL:
+            return cached[0]
+        
+        generation = self._count_generation
+        count = self._collection_call("count")
+        # Don't cache a count that a concurrent mutation has already made stale
+        if generation == self._count_generation:
+            self._count_cache = (count, time.monotonic())
+        return count
+    
+    def _invalidate_count(self):
+        """Forget the cached chunk count after adding or deleting chunks"""
+        self._count_generation += 1
+        self._count_cache = None
+    
+    def _load_embedding_model(self) -> SentenceTransformer:
+        """Load the local embedding model on the configured inference backend"""
+        if settings.embedding_backend == "torch":
+            # Use every core inside each op; inter-op parallelism only adds contention
+            torch.set_num_threads(os.cpu_count() or 1)
+            try:
+                torch.set_num_interop_threads(1)
+            except RuntimeError:
+                # Can only be set before torch starts any parallel work
+                pass
+        
+        model_kwargs = {"file_name": settings.embedding_model_file} if settings.embedding_model_file else None
+        model = SentenceTransformer(
+            'all-MiniLM-L6-v2',
+            backend=settings.embedding_backend,
+            model_kwargs=model_kwargs
+        )
+        
+        # Make sure tokenization runs in the Rust tokenizer rather than the Python one
+        if not getattr(model.tokenizer, "is_fast", True):
+            model.tokenizer = AutoTokenizer.from_pretrained(model.tokenizer.name_or_path, use_fast=True)
+        
+        return model
+    
+    def _load_doc_registry(self) -> Dict[str, str]:
+        """Collect the stored documents from chunk metadata in one pass"""
+        registry = {}
+        if self._count() == 0:
+            return registry
+        
+        all_results = self._collection_call("get", include=["metadatas"])
+        if all_results and all_results['metadatas']:
+            for metadata in all_results['metadatas']:
+                doc_id = metadata.get('document_id')
+                if doc_id and doc_id not in registry:
+                    registry[doc_id] = metadata.get('document_name', 'Unknown')
+        return registry
+    
+    def _refresh_doc_registry(self):
+        """Rebuild the document registry if it has expired"""
+        if time.monotonic() - self._doc_registry_loaded < COLLECTION_CACHE_TTL:
+            return
+        generation = self._count_generation
+        registry = self._load_doc_registry()
+        # A local write during the rebuild may be missing from it; keep the current one and retry later
+        if generation == self._count_generation:
+            self._doc_registry = registry
+            self._doc_registry_loaded = time.monotonic()
+    
+    def _collection_call(self, method: str, **kwargs):
+        """Call a collection method, reopening the collection once if another process recreated it"""
+        collection = self.collection
+        try:
+            return getattr(collection, method)(**kwargs)
+        except Exception:
+            if not self._reopen_collection(collection):
+                raise
+            return getattr(self.collection, method)(**kwargs)
+    
+    def _reopen_collection(self, stale) -> bool:
+        """Switch to the current 'documents' collection if clearing elsewhere replaced ours"""
+        try:
+            current = self._get_or_create_collection()
+        except Exception:
+            return False
+        if current.id == stale.id:
+            return False
+        logger.info("Collection 'documents' was recreated by another process; reopening it")
+        self.collection = current
+        self._invalidate_count()
+        return True
+    
+    def _get_or_create_collection(self):
+        """Open the documents collection, creating it with the right distance space"""
+        # Embeddings are L2-normalized, so inner product equals cosine similarity
+        # without the per-comparison norms. The space is fixed when a collection is created.
+        collection = self.chroma_client.get_or_create_collection(
+            name="documents",
+            metadata={"hnsw:space": "ip"}
+        )
+        
+        # An existing collection keeps the space it was created with
+        existing_space = (collection.metadata or {}).get("hnsw:space", "l2")
+        if existing_space == "cosine":
+            # Same distances for normalized vectors, only without the ip speedup
+            logger.warning(
+                "Collection 'documents' uses cosine space; clear the knowledge base to recreate it with ip"
+            )
+        elif existing_space != "ip":
+            raise Exception(
+                f"Collection 'documents' uses {existing_space} space but ip is required; "
+                f"delete {settings.chroma_db_path} to recreate it"
+            )
+        return collection
+    
+    def _openai_embedding_options(self) -> Dict:
+        """Model arguments for OpenAI embedding requests"""
+        options = {"model": settings.openai_embedding_model}
+        # Older models such as text-embedding-ada-002 reject the dimensions parameter
+        if settings.openai_embedding_dimensions:
+            options["dimensions"] = settings.openai_embedding_dimensions
+        return options
     
     def _get_embeddings(self, text: str) -> List[float]:
         """Generate embeddings for text"""
         if settings.use_local_embeddings and self.embedding_model:
-            embedding = self.embedding_model.encode(text).tolist()
-            return embedding
+            embedding = self.embedding_model.encode([text], normalize_embeddings=True, convert_to_numpy=True)
+            return embedding[0].tolist()
         elif self.openai_client:
-            response = self.openai_client.embeddings.create(
-                model="text-embedding-ada-002",
-                input=text
-            )
+            response = self.openai_client.embeddings.create(input=text, **self._openai_embedding_options())
             return response.data[0].embedding
         else:
             raise Exception("No embedding model available")
     
-    def add_document(self, document_id: str, document_name: str, content: str):
+    def _get_openai_embeddings(self, texts: List[str]) -> List[List[float]]:
+        """Embed many texts with OpenAI, sending them as list input in a few requests"""
+        if not self.openai_client:
+            raise Exception("No embedding model available")
+        
+        embeddings = []
+        for start in range(0, len(texts), OPENAI_EMBEDDING_BATCH_SIZE):
+            response = self.openai_client.embeddings.create(
+                input=texts[start:start + OPENAI_EMBEDDING_BATCH_SIZE],
+                **self._openai_embedding_options()
+            )
+            embeddings.extend(item.embedding for item in sorted(response.data, key=lambda item: item.index))
+        return embeddings
+    
+    def _embed_query(self, query: str) -> Tuple[float, ...]:
+        """Embed a search query as a hashable tuple for the LRU cache"""
+        return tuple(self._get_embeddings(query))
+    
+    def add_document(self, document_id: str, document_name: str, content: str, modified_time: str = ""):
         """Add a document to the knowledge base - optimized for speed"""
-        print(f"Processing document '{document_name}' ({len(content)} chars)...")
+        logger.debug("Processing document '%s' (%d chars)...", document_name, len(content))
         
         # For small/medium documents, process as single chunk for speed
         # For large documents, use smart chunking
         if len(content) < 3000:
             # Small document - process as single chunk (FASTEST)
-            print("Processing as single chunk for speed...")
             chunks = [content] if content.strip() else []
         else:
             # Medium/Large document - quick chunking
-            print("Chunking document...")
             chunks = self._chunk_text(content)
-            print(f"Split into {len(chunks)} chunks")
+            logger.debug("Split into %d chunks", len(chunks))
         
         if not chunks:
-            print("Warning: Document has no content")
+            logger.warning("Document '%s' has no content", document_name)
             return
         
         # Filter empty chunks
         valid_chunks = [chunk for chunk in chunks if chunk.strip()]
         if not valid_chunks:
-            print("Warning: No valid chunks found")
+            logger.warning("No valid chunks found in '%s'", document_name)
+            return
+        
+        entry = (document_id, document_name, modified_time, valid_chunks)
+        if len(content) < SMALL_DOCUMENT_CHARS:
+            # Not worth a model call of its own; encode it with the next batch
+            with self._pending_lock:
+                self._pending_small_docs[document_id] = entry
+            logger.debug("Deferred small document '%s'", document_name)
             return
         
-        print(f"Generating embeddings for {len(valid_chunks)} chunk(s)...")
+        pending = [queued for queued in self._take_pending() if queued[0] != document_id]
+        failures = self._store_isolated(pending + [entry])
+        # Deferred documents only fail on their own errors, never on this document's
+        self._log_dropped([queued for queued in pending if queued[0] in failures])
+        if document_id in failures:
+            logger.error("Error processing document '%s'", document_name, exc_info=failures[document_id])
+            raise failures[document_id]
+    
+    def _store_isolated(self, entries: List[Tuple[str, str, str, List[str]]]) -> Dict[str, Exception]:
+        """Store entries in one batch; if that fails, store each on its own
         
+        Returns the errors of the documents that could not be stored, by document_id.
+        """
         try:
-            # FAST PATH: Batch encode ALL chunks at once (super fast!)
-            if settings.use_local_embeddings and self.embedding_model:
-                # Batch encode all chunks simultaneously - much faster!
-                print("Batch encoding all chunks...")
-                embeddings = self.embedding_model.encode(valid_chunks, show_progress_bar=False, batch_size=32, convert_to_numpy=True)
-                if hasattr(embeddings, 'tolist'):
-                    embeddings_list = embeddings.tolist()
-                else:
-                    embeddings_list = [emb.tolist() if hasattr(emb, 'tolist') else emb for emb in embeddings]
-            else:
-                # Fallback for OpenAI embeddings
-                embeddings_list = [self._get_embeddings(chunk) for chunk in valid_chunks]
-            
-            # Prepare data for ChromaDB
-            ids_to_add = [f"{document_id}_{i}" for i in range(len(valid_chunks))]
-            metadatas_to_add = [{
-                "document_id": document_id,
-                "document_name": document_name,
-                "chunk_index": i
-            } for i in range(len(valid_chunks))]
-            
-            print(f"Storing {len(embeddings_list)} chunk(s) in vector database...")
-            # Batch add to ChromaDB
-            self.collection.add(
-                embeddings=embeddings_list,
-                documents=valid_chunks,
-                metadatas=metadatas_to_add,
-                ids=ids_to_add
-            )
-            print(f"✓ Successfully added '{document_name}' with {len(embeddings_list)} chunk(s)")
-            
+            self._store(entries)
+            return {}
         except Exception as e:
-            print(f"Error processing document: {str(e)}")
-            import traceback
-            traceback.print_exc()
-            raise
+            if len(entries) == 1:
+                return {entries[0][0]: e}
+        
+        failures = {}
+        for entry in entries:
+            try:
+                self._store([entry])
+            except Exception as e:
+                failures[entry[0]] = e
+        return failures
+    
+    def _store(self, entries: List[Tuple[str, str, str, List[str]]]):
+        """Embed the chunks of one or more documents in one batch and add them to ChromaDB"""
+        texts = [chunk for _, _, _, chunks in entries for chunk in chunks]
+        logger.debug("Generating embeddings for %d chunk(s)...", len(texts))
+        
+        # FAST PATH: Batch encode ALL chunks at once (super fast!)
+        if settings.use_local_embeddings and self.embedding_model:
+            # Batch encode all chunks, sharing model batches with concurrent uploads.
+            # Chroma accepts the ndarray as is, so no nested Python list is built
+            embeddings = self._embed_batcher.encode(texts)
+        else:
+            # Fallback for OpenAI embeddings: one request per batch of chunks
+            embeddings = self._get_openai_embeddings(texts)
+        
+        # Prepare data for ChromaDB
+        ids_to_add = []
+        metadatas_to_add = []
+        for document_id, document_name, modified_time, chunks in entries:
+            for i in range(len(chunks)):
+                ids_to_add.append(f"{document_id}_{i}")
+                metadatas_to_add.append({
+                    "document_id": document_id,
+                    "document_name": document_name,
+                    "modified_time": modified_time,
+                    "chunk_index": i
+                })
+        
+        logger.debug("Storing %d chunk(s) in vector database...", len(embeddings))
+        # Batch add to ChromaDB
+        self._collection_call(
+            "add",
+            embeddings=embeddings,
+            documents=texts,
+            metadatas=metadatas_to_add,
+            ids=ids_to_add
+        )
+        self._invalidate_count()
+        for document_id, document_name, _, chunks in entries:
+            self._doc_registry[document_id] = document_name
+            logger.info("Added '%s' with %d chunk(s)", document_name, len(chunks))
+    
+    def _take_pending(self) -> List[Tuple[str, str, str, List[str]]]:
+        with self._pending_lock:
+            pending, self._pending_small_docs = self._pending_small_docs, {}
+        return list(pending.values())
+    
+    def _log_dropped(self, pending: List[Tuple[str, str, str, List[str]]]):
+        for _, document_name, _, _ in pending:
+            logger.error("Dropped deferred document '%s'; add it again to index it", document_name)
+    
+    def flush_pending(self):
+        """Encode and store any deferred small documents
+        
+        Documents that fail are dropped (and logged) rather than re-queued, so
+        one bad document cannot fail every later flush; the others are stored.
+        """
+        pending = self._take_pending()
+        if not pending:
+            return
+        failures = self._store_isolated(pending)
+        if failures:
+            dropped = [entry for entry in pending if entry[0] in failures]
+            self._log_dropped(dropped)
+            raise Exception(
+                f"Could not store {len(dropped)} deferred document(s): "
+                + ", ".join(f"{entry[1]} ({failures[entry[0]]})" for entry in dropped)
+            )
+    
+    def _flush_pending_for_read(self):
+        """Flush deferred documents before a read, without letting a failure break the read"""
+        try:
+            self.flush_pending()
+        except Exception:
+            # Already logged by flush_pending
+            pass
+    
+    def _drop_pending(self, document_ids) -> None:
+        """Forget deferred documents that are being removed"""
+        with self._pending_lock:
+            for document_id in document_ids:
+                self._pending_small_docs.pop(document_id, None)
     
     def _chunk_text(self, text: str, chunk_size: int = 2000, overlap: int = 200) -> List[str]:
         """Split text into overlapping chunks - optimized for speed"""
         if len(text) <= chunk_size:
             return [text]
         
-        # Fast chunking: simple split without complex boundary detection
+        # Find every sentence end once; each chunk then picks its break by binary search
+        boundaries = np.fromiter((m.end() for m in _SENTENCE_END_RE.finditer(text)), dtype=np.int64)
+        
         chunks = []
         start = 0
+        text_len = len(text)
         
-        while start < len(text):
+        while start < text_len:
             end = start + chunk_size
             
-            # Simple sentence boundary detection (faster)
-            if end < len(text):
-                # Quick check for sentence end
-                period_pos = text.rfind('. ', start, end)
-                if period_pos == -1:
-                    period_pos = text.rfind('.\n', start, end)
-                if period_pos != -1:
-                    end = period_pos + 2
+            if end < text_len:
+                # Last sentence end inside the window; it must lie past the overlap
+                # so the next chunk still starts further along
+                idx = np.searchsorted(boundaries, end, side='right') - 1
+                if idx >= 0 and boundaries[idx] > start + overlap:
+                    end = int(boundaries[idx])
             
             chunk = text[start:end].strip()
             if chunk:
                 chunks.append(chunk)
             
-            start = end - overlap if end < len(text) else end
+            start = end - overlap if end < text_len else end
         
         return chunks
     
     def remove_document(self, document_id: str):
         """Remove a document from the knowledge base"""
-        # Get all chunks for this document
-        results = self.collection.get(
-            where={"document_id": document_id}
+        self._drop_pending({document_id})
+        
+        # Get the IDs of all chunks for this document (ids are always returned)
+        results = self._collection_call(
+            "get",
+            where={"document_id": document_id},
+            include=[]
         )
         
         if results and results['ids']:
-            self.collection.delete(ids=results['ids'])
+            self._collection_call("delete", ids=results['ids'])
+            self._invalidate_count()
+        self._doc_registry.pop(document_id, None)
+    
+    def get_modified_time(self, document_id: str) -> Optional[str]:
+        """Drive modifiedTime of the indexed version of a document, if any"""
+        with self._pending_lock:
+            entry = self._pending_small_docs.get(document_id)
+        if entry:
+            return entry[2] or None
+        
+        results = self._collection_call(
+            "get",
+            where={"document_id": document_id},
+            limit=1,
+            include=["metadatas"]
+        )
+        if results and results['metadatas']:
+            return results['metadatas'][0].get('modified_time') or None
+        return None
+    
+    def remove_documents(self, document_ids: List[str]):
+        """Remove several documents from the knowledge base in one delete"""
+        if not document_ids:
+            return
+        self._drop_pending(set(document_ids))
+        self._collection_call("delete", where={"document_id": {"$in": list(document_ids)}})
+        self._invalidate_count()
+        for document_id in document_ids:
+            self._doc_registry.pop(document_id, None)
     
-    def search(self, query: str, top_k: int = 5) -> Tuple[List[Dict], List[float]]:
-        """Search for relevant document chunks"""
-        if self.collection.count() == 0:
-            return [], []
+    def search(self, query: str, top_k: int = 5, document_ids: Optional[List[str]] = None) -> SearchResult:
+        """Search for relevant document chunks, optionally only within the given documents"""
+        self._flush_pending_for_read()
+        count = self._count()
+        if count == 0:
+            return SearchResult()
         
         # Generate query embedding
-        query_embedding = self._get_embeddings(query)
+        query_embedding = list(self._cached_query_embedding(query))
+        
+        # Filter by document before the ANN search so only their chunks are visited
+        if not document_ids:
+            where_clause = None
+        elif len(document_ids) == 1:
+            where_clause = {"document_id": {"$eq": document_ids[0]}}
+        else:
+            where_clause = {"document_id": {"$in": list(document_ids)}}
         
         # Search in ChromaDB
-        results = self.collection.query(
+        results = self._collection_call(
+            "query",
             query_embeddings=[query_embedding],
-            n_results=min(top_k, self.collection.count())
+            n_results=min(top_k, count),
+            where=where_clause
         )
         
-        # Extract results
-        documents = []
-        scores = []
+        # Take the columns for our single query as they are
+        if not results['documents'] or not results['documents'][0]:
+            return SearchResult()
         
-        if results['documents'] and len(results['documents'][0]) > 0:
-            for i in range(len(results['documents'][0])):
-                documents.append({
-                    'content': results['documents'][0][i],
-                    'metadata': results['metadatas'][0][i] if results['metadatas'] else {},
-                    'distance': results['distances'][0][i] if results['distances'] else 0.0
-                })
-                scores.append(results['distances'][0][i] if results['distances'] else 0.0)
+        contents = results['documents'][0]
+        metadatas = results['metadatas'][0] if results['metadatas'] else [{}] * len(contents)
+        if results['distances']:
+            distances = np.asarray(results['distances'][0], dtype=np.float64)
+        else:
+            distances = np.zeros(len(contents))
         
-        return documents, scores
+        return SearchResult(contents, metadatas, distances)
     
     def generate_response(
         self,
         query: str,
-        retrieved_contexts: List[Dict],
-        found_in_documents: bool
-    ) -> str:
-        """Generate response using LLM"""
+        retrieved_contexts: SearchResult,
+        found_in_documents: bool,
+        stream: bool = False
+    ) -> Union[str, Iterator[str]]:
+        """Generate response using LLM
+
+        With stream=True, returns an iterator of text pieces as they are generated.
+        """
+        
+        if stream:
+            if self.openai_client:
+                return self._generate_with_openai_stream(query, retrieved_contexts, found_in_documents)
+            return iter([self._generate_simple_response(query, retrieved_contexts, found_in_documents)])
         
         if self.openai_client:
             return self._generate_with_openai(query, retrieved_contexts, found_in_documents)
         else:
             return self._generate_simple_response(query, retrieved_contexts, found_in_documents)
     
-    def _generate_with_openai(
+    def _build_prompt(
         self,
         query: str,
-        retrieved_contexts: List[Dict],
+        retrieved_contexts: SearchResult,
         found_in_documents: bool
     ) -> str:
-        """Generate response using OpenAI"""
-        
-        # Build context from retrieved documents
-        context_parts = []
-        sources = []
+        """Build the OpenAI prompt from the retrieved documents"""
+        context = "\n\n".join(retrieved_contexts.contents)
         
-        for ctx in retrieved_contexts:
-            content = ctx['content']
-            metadata = ctx.get('metadata', {})
-            doc_name = metadata.get('document_name', 'Unknown')
-            
-            context_parts.append(content)
-            if doc_name not in sources:
-                sources.append(doc_name)
-        
-        context = "\n\n".join(context_parts)
-        
-        # Build prompt
         if found_in_documents and context:
-            prompt = f"""You are a helpful assistant that answers questions based on the provided documents.
+            return f"""You are a helpful assistant that answers questions based on the provided documents.
 
 Context from user's documents:
 {context}
@@ -244,18 +658,30 @@ Context from user's documents:
 Question: {query}
 
 Answer the question based on the context provided. If the context doesn't fully answer the question, say so but provide the best answer you can from the context."""
-        else:
-            prompt = f"""The user asked: {query}
+        
+        return f"""The user asked: {query}
 
 Note: The answer was not found in the user's documents. Please provide a helpful answer from your general knowledge."""
+    
+    def _openai_messages(self, prompt: str) -> List[Dict[str, str]]:
+        return [
+            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "user", "content": prompt}
+        ]
+    
+    def _generate_with_openai(
+        self,
+        query: str,
+        retrieved_contexts: SearchResult,
+        found_in_documents: bool
+    ) -> str:
+        """Generate response using OpenAI"""
+        prompt = self._build_prompt(query, retrieved_contexts, found_in_documents)
         
         try:
             response = self.openai_client.chat.completions.create(
                 model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system", "content": "You are a helpful assistant."},
-                    {"role": "user", "content": prompt}
-                ],
+                messages=self._openai_messages(prompt),
                 max_tokens=500,
                 temperature=0.7
             )
@@ -264,39 +690,71 @@ Note: The answer was not found in the user's documents. Please provide a helpful
             
         except Exception as e:
             # If OpenAI fails, fall back to simple response using retrieved contexts
-            print(f"OpenAI API error: {str(e)}, using fallback response")
+            logger.warning("OpenAI API error: %s, using fallback response", e)
             return self._generate_simple_response(query, retrieved_contexts, found_in_documents)
     
+    def _generate_with_openai_stream(
+        self,
+        query: str,
+        retrieved_contexts: SearchResult,
+        found_in_documents: bool
+    ) -> Iterator[str]:
+        """Generate response using OpenAI, yielding tokens as they arrive"""
+        prompt = self._build_prompt(query, retrieved_contexts, found_in_documents)
+        
+        yielded = False
+        try:
+            response = self.openai_client.chat.completions.create(
+                model="gpt-3.5-turbo",
+                messages=self._openai_messages(prompt),
+                max_tokens=500,
+                temperature=0.7,
+                stream=True
+            )
+            
+            for chunk in response:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    yielded = True
+                    yield delta
+            
+        except Exception as e:
+            # Fall back to the simple response, unless part of the answer was already sent
+            logger.warning("OpenAI API error: %s", e)
+            if not yielded:
+                yield self._generate_simple_response(query, retrieved_contexts, found_in_documents)
+    
     def _generate_simple_response(
         self,
         query: str,
-        retrieved_contexts: List[Dict],
+        retrieved_contexts: SearchResult,
         found_in_documents: bool
     ) -> str:
         """Simple fallback response generation (without OpenAI)"""
+        # Only the top 5 results are used; key the cache on their content and document names
+        top = retrieved_contexts.head(5)
+        contexts = tuple(zip(top.contents, top.doc_names))
+        return self._simple_response_cache(query, contexts, found_in_documents)
+    
+    def _format_simple_response(
+        self,
+        query: str,
+        contexts: Tuple[Tuple[str, str], ...],
+        found_in_documents: bool
+    ) -> str:
+        """Format the fallback response from (content, document name) pairs"""
         
-        if found_in_documents and retrieved_contexts:
+        if found_in_documents and contexts:
             # Combine multiple relevant contexts for better answer
-            context_parts = []
             doc_content_map = {}  # Map doc_name to list of content chunks
             
             # Group content by document
-            for ctx in retrieved_contexts[:5]:  # Use top 5 results
-                content = ctx.get('content', '').strip()
-                metadata = ctx.get('metadata', {})
-                doc_name = metadata.get('document_name', 'Document')
+            for content, doc_name in contexts:
+                content = content.strip()
                 
                 if content:
-                    # Clean up the content (remove excessive whitespace, fix newlines)
-                    content = ' '.join(content.split())
-                    # Limit each chunk to avoid showing incomplete sentences
-                    if len(content) > 500:
-                        # Try to find a sentence break
-                        last_period = content[:500].rfind('.')
-                        if last_period > 300:
-                            content = content[:last_period + 1] + "..."
-                        else:
-                            content = content[:500] + "..."
+                    # Clean up the content and cut it at a sentence break
+                    content = _trim_to_sentence(content)
                     
                     # Group content by document
                     if doc_name not in doc_content_map:
@@ -336,7 +794,7 @@ Note: The answer was not found in the user's documents. Please provide a helpful
                 # Limit response length but keep it natural
                 if len(combined_text) > 1000:
                     # Find a good stopping point
-                    cutoff = combined_text[:1000].rfind('.')
+                    cutoff = combined_text.rfind('.', 0, 1000)
                     if cutoff > 700:
                         response += combined_text[:cutoff+1] + " For more details, please refer to the full documents."
                     else:
@@ -344,9 +802,9 @@ Note: The answer was not found in the user's documents. Please provide a helpful
                 else:
                     response += combined_text
         else:
-            if retrieved_contexts:
+            if contexts:
                 # We have contexts but they're not very relevant
-                best_context = retrieved_contexts[0].get('content', '')
+                best_context = contexts[0][0]
                 if best_context:
                     response = f"I found some information in your documents, though it may not directly answer '{query}':\n\n"
                     response += best_context[:600]
@@ -367,22 +825,13 @@ Note: The answer was not found in the user's documents. Please provide a helpful
         
         # Take the most relevant sentences (first few usually have the main info)
         key_sentences = []
-        seen_words = set()
+        query_words = frozenset(query.lower().split())
         
-        query_words = set(query.lower().split())
-        
-        for sentence in sentences[:15]:  # Check first 15 sentences
-            sentence_lower = sentence.lower()
-            # Check if sentence relates to query
-            sentence_words = set(sentence_lower.split())
-            relevance = len(query_words.intersection(sentence_words))
-            
-            if relevance > 0 or len(key_sentences) < 5:
-                # Avoid repetition
-                words_in_sentence = tuple(sorted(sentence_words))
-                if words_in_sentence not in seen_words or len(key_sentences) < 3:
-                    key_sentences.append(sentence.strip())
-                    seen_words.add(words_in_sentence)
+        # Check the first 15 sentences, dropping repeats while keeping their order
+        for sentence in dict.fromkeys(sentence.strip() for sentence in sentences[:15]):
+            # Keep the opening sentences, then only those sharing a word with the query
+            if len(key_sentences) < 5 or not query_words.isdisjoint(sentence.lower().split()):
+                key_sentences.append(sentence)
         
         if not key_sentences:
             # Fallback to first few sentences
@@ -402,7 +851,7 @@ Note: The answer was not found in the user's documents. Please provide a helpful
         
         # Limit length
         if len(response) > 800:
-            cutoff = response[:800].rfind('.')
+            cutoff = response.rfind('.', 0, 800)
             if cutoff > 500:
                 response = response[:cutoff+1]
             else:
@@ -412,31 +861,21 @@ Note: The answer was not found in the user's documents. Please provide a helpful
     
     def clear_all_documents(self):
         """Clear all documents from knowledge base"""
+        self._take_pending()
         try:
-            if self.collection.count() > 0:
-                # Get all IDs and delete
-                all_results = self.collection.get()
-                if all_results and all_results['ids']:
-                    self.collection.delete(ids=all_results['ids'])
-                print("Knowledge base cleared")
+            # Drop the collection and its HNSW index wholesale instead of deleting point by point.
+            # Not gated on the cached count: another worker may have added documents
+            self.chroma_client.delete_collection("documents")
+            self.collection = self._get_or_create_collection()
+            self._invalidate_count()
+            self._doc_registry.clear()
+            logger.info("Knowledge base cleared")
         except Exception as e:
-            print(f"Error clearing knowledge base: {str(e)}")
+            logger.error("Error clearing knowledge base: %s", e)
     
     def get_knowledge_base_documents(self) -> List[Dict[str, str]]:
         """Get list of all documents in knowledge base"""
-        if self.collection.count() == 0:
-            return []
-        
-        # Get all unique documents
-        all_results = self.collection.get()
-        
-        documents = {}
-        if all_results and all_results['metadatas']:
-            for metadata in all_results['metadatas']:
-                doc_id = metadata.get('document_id')
-                doc_name = metadata.get('document_name', 'Unknown')
-                if doc_id and doc_id not in documents:
-                    documents[doc_id] = doc_name
-        
-        return [{"id": doc_id, "name": doc_name} for doc_id, doc_name in documents.items()]
+        self._flush_pending_for_read()
+        self._refresh_doc_registry()
+        return [{"id": doc_id, "name": doc_name} for doc_id, doc_name in list(self._doc_registry.items())]
 
@@ -0,0 +1,43 @@
+"""Client-side rate limiting for outgoing API requests"""
+
+import asyncio
+import time
+
+
+class TokenBucket:
+    """Asynchronous token bucket.
+
+    Holds up to `capacity` tokens and refills at `rate` tokens per second.
+    Callers wait for a token before each request, which keeps bursts under the
+    upstream quota instead of tripping 429s and their retry backoff.
+    """
+    
+    def __init__(self, capacity: float, rate: float):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self._lock = asyncio.Lock()
+    
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+    
+    async def acquire(self, n: float = 1):
+        """Wait until n tokens are available and take them"""
+        n = min(n, self.capacity)
+        # Waiters queue on the lock, so tokens are handed out in arrival order
+        async with self._lock:
+            self._refill()
+            if self.tokens < n:
+                await asyncio.sleep((n - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= n
+    
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
@@ -0,0 +1,99 @@
+"""Session and OAuth flow storage"""
+
+import time
+from typing import Optional
+import orjson
+from google.oauth2.credentials import Credentials
+from google_auth_oauthlib.flow import Flow
+from redis import asyncio as aioredis
+from backend.auth import GoogleAuth
+from backend.config import settings
+
+# Pending OAuth flows are dropped after this many seconds
+FLOW_TTL_SECONDS = 600
+
+
+class SessionStore:
+    """Store user sessions and pending OAuth flows.
+
+    With redis_url configured both live in Redis, so every worker sees them and
+    restarts keep users logged in. Otherwise they are kept in process memory and
+    credentials are persisted to disk by GoogleAuth.
+    """
+    
+    def __init__(self, auth: GoogleAuth):
+        self.auth = auth
+        self.redis = aioredis.from_url(settings.redis_url) if settings.redis_url else None
+        self._sessions = {}
+        # {state: (flow, created_at)}
+        self._flows = {}
+    
+    async def save_session(self, session_id: str, credentials: Credentials):
+        """Store credentials for a new session"""
+        creds_dict = self.auth.credentials_to_dict(credentials)
+        if self.redis:
+            await self.redis.set(
+                f"sess:{session_id}",
+                orjson.dumps(creds_dict),
+                ex=settings.session_max_age_days * 86400
+            )
+            return
+        
+        self._sessions[session_id] = creds_dict
+        self.auth.save_session(session_id, credentials)
+    
+    async def load_session(self, session_id: str) -> Optional[Credentials]:
+        """Get the credentials of a session, or None if it is unknown"""
+        if self.redis:
+            data = await self.redis.get(f"sess:{session_id}")
+            if data is None:
+                return None
+            return self.auth.dict_to_credentials(orjson.loads(data))
+        
+        if session_id in self._sessions:
+            return self.auth.dict_to_credentials(self._sessions[session_id])
+        
+        # Fall back to credentials persisted by a previous server run
+        credentials = self.auth.load_session(session_id)
+        if credentials is not None:
+            self._sessions[session_id] = self.auth.credentials_to_dict(credentials)
+        return credentials
+    
+    async def save_flow(self, state: str, flow: Flow):
+        """Keep an OAuth flow until its callback arrives"""
+        if self.redis:
+            # Flow objects can't be serialized; keep what is needed to rebuild one
+            await self.redis.set(
+                f"flow:{state}",
+                orjson.dumps({"code_verifier": flow.code_verifier}),
+                ex=FLOW_TTL_SECONDS
+            )
+            return
+        
+        self._sweep_flows()
+        self._flows[state] = (flow, time.monotonic())
+    
+    async def pop_flow(self, state: str) -> Optional[Flow]:
+        """Remove and return the OAuth flow for a state, or None if unknown or expired"""
+        if self.redis:
+            data = await self.redis.getdel(f"flow:{state}")
+            if data is None:
+                return None
+            return self.auth.create_flow(state=state, code_verifier=orjson.loads(data)["code_verifier"])
+        
+        self._sweep_flows()
+        entry = self._flows.pop(state, None)
+        return entry[0] if entry else None
+    
+    def purge_stale_sessions(self) -> int:
+        """Delete persisted sessions that are too old (Redis expires them itself)"""
+        if self.redis:
+            return 0
+        return self.auth.purge_stale_sessions()
+    
+    def _sweep_flows(self):
+        """Forget OAuth flows whose callback never arrived"""
+        cutoff = time.monotonic() - FLOW_TTL_SECONDS
+        for state, (_, created_at) in list(self._flows.items()):
+            if created_at < cutoff:
+                self._flows.pop(state, None)
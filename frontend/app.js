@@ -1,8 +1,9 @@
 // Frontend JavaScript for RAG Chatbot
 
-const API_BASE_URL = 'http://localhost:8000';
+const API_BASE_URL = window.location.origin;
 let sessionId = null;
 let selectedDocuments = new Set();
+let documentNames = {};
 let conversationId = null;
 
 // Initialize app
@@ -86,6 +87,7 @@ function createDocumentElement(doc) {
     const div = document.createElement('div');
     div.className = 'document-item';
     div.dataset.docId = doc.id;
+    documentNames[doc.id] = doc.name;
     
     const checkbox = document.createElement('input');
     checkbox.type = 'checkbox';
@@ -167,7 +169,10 @@ async function addToKnowledgeBase() {
                 'Content-Type': 'application/json'
             },
             body: JSON.stringify({
-                document_ids: Array.from(selectedDocuments)
+                document_ids: Array.from(selectedDocuments),
+                document_names: Object.fromEntries(
+                    Array.from(selectedDocuments).map(id => [id, documentNames[id]])
+                )
             }),
             signal: controller.signal
         });
@@ -287,20 +292,51 @@ async function sendMessage() {
             },
             body: JSON.stringify({
                 query: query,
-                conversation_id: conversationId
+                conversation_id: conversationId,
+                stream: true
             })
         });
         
-        const data = await response.json();
+        if (!response.ok) {
+            throw new Error(`Server error: ${response.status}`);
+        }
+        
+        // The response is newline-delimited JSON: a metadata line, then text deltas
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        const loadingContent = document.querySelector(`#${loadingId} .message-content`);
+        let buffer = '';
+        let meta = null;
+        let text = '';
+        
+        while (true) {
+            const { done, value } = await reader.read();
+            if (done) break;
+            
+            buffer += decoder.decode(value, { stream: true });
+            const lines = buffer.split('\n');
+            buffer = lines.pop();
+            
+            for (const line of lines) {
+                if (!line) continue;
+                const event = JSON.parse(line);
+                if (meta === null) {
+                    meta = event;
+                } else {
+                    text += event.delta;
+                    loadingContent.textContent = text;
+                }
+            }
+        }
         
         // Update conversation ID
-        conversationId = data.conversation_id;
+        conversationId = meta.conversation_id;
         
         // Remove loading message
         document.getElementById(loadingId)?.remove();
         
         // Add assistant response
-        addMessageToChat('assistant', data.response, false, data.found_in_documents, data.sources);
+        addMessageToChat('assistant', text, false, meta.found_in_documents, meta.sources);
         
     } catch (error) {
         document.getElementById(loadingId)?.remove();